@@ -10,6 +10,11 @@ import surfa as sf
 
 script_desc = 'Check if an mgz file can safely converted ints'
 
+# Size in bytes of the blocks checked at a time by can_convert_to_int; small
+# enough that a block and its scratch buffer stay in cache. Sized in bytes
+# rather than voxels so float32 and float64 volumes use the same footprint
+scan_block_bytes = 256 * 1024
+
 # Setup logging
 logger = logging.getLogger(__name__)
 
@@ -26,20 +31,34 @@ def parse_args():
     
 def can_convert_to_int(numpy_array, tol=1e-10, dtype=np.int32):
     
-    if np.issubdtype(numpy_array.dtype, np.integer):
+    if numpy_array.dtype.kind in 'iu':
         return False, f"Array is alreay an integer type ({numpy_array.dtype})"
 
-    # Check if conversion is safe
-    if np.any(np.isnan(numpy_array)):
-        return False, "Array contains NaN values"
+    # Check if conversion is safe. Walk the array once, a block at a time, so
+    # every voxel is only streamed from memory once and we can stop at the
+    # first block that fails instead of scanning the whole volume
+    flat_array = numpy_array.ravel(order='K')
+    block_size = max(1, scan_block_bytes // flat_array.itemsize)
+    # The scratch buffer must be able to hold np.rint's result, which is a
+    # float even for e.g. boolean input
+    rounded_block = np.empty(min(flat_array.size, block_size),
+                             dtype=np.result_type(flat_array.dtype, np.float16))
+    for start in range(0, flat_array.size, block_size):
+        block = flat_array[start:start + block_size]
+        rounded = rounded_block[:block.size]
 
-    if np.any(np.isinf(numpy_array)):
-        return False, "Array contains infinity values"
+        if not np.isfinite(block).all():
+            if np.isnan(block).any():
+                return False, "Array contains NaN values"
+            return False, "Array contains infinity values"
 
-    rounded_array = np.round(numpy_array)
-    if not np.allclose(numpy_array, rounded_array, rtol=0, atol=tol):
-        max_dev = np.max(np.abs(numpy_array - rounded_array))
-        return False, f"Values deviate from integers by up to {max_dev}"
+        # Reuse the rounded buffer for the deviation, so no temporaries are
+        # allocated and the tolerance check is a single max() reduction
+        np.rint(block, out=rounded)
+        np.subtract(block, rounded, out=rounded)
+        max_dev = np.abs(rounded, out=rounded).max()
+        if max_dev > tol:
+            return False, f"Values deviate from integers by at least {max_dev}"
     
     return True, "Safe to convert to ints"
 
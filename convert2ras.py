@@ -3,6 +3,7 @@
 import sys
 import argparse
 import nibabel as nb
+import numpy as np
 
 def parse_args():
     script_desc = 'Converts imaging files to RAS.'
@@ -26,7 +27,15 @@ def convert_orientation(infile, outfile, target_orientation = 'RAS'):
       nb.orientations.axcodes2ornt(target_orientation),
     )
 
+    # as_reoriented only returns flipped/transposed views of the data; make a
+    # single copy in fortran order (the order the data is written to disk in)
+    # so saving doesn't have to walk a strided view
     reoriented_img = input_img.as_reoriented(transformation)
+    reoriented_img = reoriented_img.__class__(
+      np.asfortranarray(reoriented_img.dataobj),
+      reoriented_img.affine,
+      reoriented_img.header,
+    )
     nb.save(reoriented_img, outfile)
     return 0
     
@@ -3,8 +3,13 @@
 import sys
 import os
 import argparse
+import concurrent.futures
+import functools
+import gzip
 import logging
 import pathlib
+import shutil
+import tempfile
 import traceback
 
 import numpy as np
@@ -12,6 +17,7 @@ import surfa as sf
 
 # See https://github.com/freesurfer/surfa/blob/0ab851a36703458023d9ada9cac466d045829399/surfa/core/framed.py#L11C7-L11C25
 from surfa.core.framed import FramedArrayIntents
+from surfa.io.framed import MGHArrayIO
 
 from can_convert_mgz_to_int import can_convert_to_int
 
@@ -32,6 +38,42 @@ for dtype_str in mgz_dtypes:
     info = np.iinfo(dtype)
     mgz_dtype_info.append((dtype_str, info.min, info.max))
 
+# The same info as arrays of names, minimums and maximums, so a range can be
+# checked against every dtype at once
+mgz_dtype_bounds = (
+    [info[0] for info in mgz_dtype_info],
+    np.array([info[1] for info in mgz_dtype_info], dtype=np.int64),
+    np.array([info[2] for info in mgz_dtype_info], dtype=np.int64),
+)
+
+# Number of voxels reduced at a time when scanning a volume; small enough that
+# a block stays in cache between consecutive reductions
+scan_block_size = 1 << 16
+
+# Approximate number of voxels sampled by find_best_dtype before a full scan
+dtype_sample_size = 1 << 16
+
+# The MGH header is a fixed 284 bytes, followed by the voxel data and then
+# optional scan parameters and tags. Offsets of the fields we need:
+# See: https://surfer.nmr.mgh.harvard.edu/fswiki/FsTutorial/MghFormat
+mgh_header_size = 284
+mgh_shape_offset = 4
+mgh_dtype_offset = 20
+mgh_good_ras_offset = 28
+mgh_voxsize_offset = 30
+mgh_rotation_offset = 42
+mgh_center_offset = 78
+
+# mgz files larger than this (compressed, in bytes) are decompressed into a
+# memory-mapped temporary file rather than read into RAM. This and the
+# uncompressed file written by save_mgz() go next to the output file (or in
+# --tmpdir), not in $TMPDIR, which is often a RAM-backed tmpfs
+mmap_load_threshold = 100 * 1024 * 1024
+
+# Buffer size for the compressed input stream; gzip reads the underlying file
+# in small chunks, so without a large buffer every chunk costs a syscall
+gzip_buffer_size = 1 << 20
+
 # FreeSurfer label files
 # todo; finalize
 
@@ -89,6 +131,13 @@ mgz_label_files = [
   'wm.asegedit.mgz',
   'wmparc.mgz'
 ]
+# For constant time lookups by filename
+mgz_label_file_set = frozenset(mgz_label_files)
+
+# Output buffer for convert_dtype(), keyed by (shape, dtype, order). Batches
+# are mostly volumes of the same shape, so this is reused from file to file;
+# only the most recently used buffer is kept
+out_buf_cache = {}
 
 # Setup logging
 logger = logging.getLogger(__name__)
@@ -98,6 +147,16 @@ def parse_args():
     parser.add_argument('-i', '--inpath', required=True, help='Input path (required)')
     parser.add_argument('-o', '--outpath', required=False, help='Output path')
     parser.add_argument('-f', '--force', action='store_true', help='Force conversion to ints')
+    parser.add_argument('-z', '--compresslevel', type=int,
+                        help='gzip compression level for mgz output, 0-9 (default: surfa\'s own level). '
+                             'Setting a level writes the volume uncompressed to a temporary file and then '
+                             'compresses it, trading extra I/O for less CPU at low levels')
+    parser.add_argument('--tmpdir',
+                        help='Disk-backed directory for temporary files: decompressed large mgz inputs, '
+                             'and the uncompressed output written when --compresslevel is set '
+                             '(default: the output directory)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of files to optimize in parallel (default: number of CPUs)')
     parser.add_argument('--log-level', 
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         default='WARNING',
@@ -122,6 +181,22 @@ def parse_args():
     args = parser.parse_args()
     return args
 
+def walk_mgz_files(root):
+    # Iterative os.scandir walk; DirEntry caches the file type from the
+    # directory listing, so unlike Path.rglob there is no stat() per entry
+    stack = [root]
+    while stack:
+        # Like Path.rglob, silently skip directories we can't read
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith('.mgz'):
+                        yield entry.path
+        except PermissionError:
+            continue
+
 def check_args(args):
     infilelist = []
     outfilelist = []
@@ -146,6 +221,12 @@ def check_args(args):
         else:
             outpath = None
 
+        if args.compresslevel is not None and not 0 <= args.compresslevel <= 9:
+            raise ValueError(f'compresslevel must be between 0 and 9: {args.compresslevel}')
+        if args.tmpdir is not None and not os.path.isdir(args.tmpdir):
+            raise ValueError(f'tmpdir is not a directory: {args.tmpdir}')
+        if args.jobs < 1:
+            raise ValueError(f'jobs must be at least 1: {args.jobs}')
         if not inpath.exists():
             raise ValueError(f'path does not exist: {args.inpath}')
         if inpath.is_file():
@@ -165,50 +246,212 @@ def check_args(args):
                 outpath = inpath
             if outpath.is_file():
                 raise ValueError(f'outpath has been defined as a file, but inpath is a dir.  inpath: {args.inpath}; outpath: {args.outpath}')
-            mgz_files = list(inpath.rglob('*.mgz'))
+            inpath_abs = os.path.abspath(inpath)
+            outpath_abs = os.path.abspath(outpath)
+            mgz_files = list(walk_mgz_files(inpath_abs))
             for mgz_file in mgz_files:
-                infilelist.append(os.path.join(inpath.absolute(), mgz_file.absolute()))
-                outfilelist.append(os.path.join(outpath.absolute(), mgz_file.absolute()))
+                infilelist.append(os.path.join(inpath_abs, mgz_file))
+                outfilelist.append(os.path.join(outpath_abs, mgz_file))
         else:
             raise ValueError(f'inpath is neither a file nor a directory: {args.inpath}')
     except (OSError, ValueError, AssertionError) as e:
         error_msg = str(e)
         logger.error(f'caught an exception: {error_msg}', exc_info=True)
         raise
-    return infilelist, outfilelist, intent
+
+    # Resolve the intent for each file up front, so the workers don't have to
+    if intent == FramedArrayIntents.unknown:
+        intentlist = []
+        for infile in infilelist:
+            # try to guess the intent code from the filename
+            file_intent = guess_intent_code_from_filename(infile)
+            logger.info(f'intent was None, so I guessed from the filename that {infile} should be {file_intent}')
+            intentlist.append(file_intent)
+    else:
+        intentlist = [intent] * len(infilelist)
+    return infilelist, outfilelist, intentlist
             
-def find_best_dtype(np_array, possible_dtypes=mgz_dtype_info):
-    min_val = np.min(np_array)
-    max_val = np.max(np_array)
-    # Find the smallest dtype that can accommodate the range
-    for dtype_str, dtype_min, dtype_max in possible_dtypes:
-        if dtype_min <= min_val and max_val <= dtype_max:
+def read_exactly(file, np_array, infile):
+    # Fill the array's memory directly from the file, without intermediate copies
+    buffer = memoryview(np_array.ravel(order='K').view(np.uint8))
+    while buffer:
+        nbytes = file.readinto(buffer)
+        if not nbytes:
+            raise ValueError(f'unexpected end of file while reading voxel data: {infile}')
+        buffer = buffer[nbytes:]
+
+def load_mgz(infile, use_mmap=False, spill_dir=None):
+    # Read an mgz file through a buffered gzip stream. If use_mmap is set, the
+    # voxel data is decompressed into an anonymous temporary file in spill_dir
+    # and memory mapped, so the OS can page the volume out instead of holding
+    # it in RAM. spill_dir should be on disk; tmpfs would keep it in memory
+    with open(infile, 'rb', buffering=gzip_buffer_size) as raw, gzip.GzipFile(fileobj=raw, mode='rb') as file:
+        header = file.read(mgh_header_size)
+        if len(header) != mgh_header_size:
+            raise ValueError(f'file is too short to be an mgz file: {infile}')
+        shape = tuple(int(n) for n in np.frombuffer(header, dtype='>u4', count=4, offset=mgh_shape_offset))
+        dtype_id = int(np.frombuffer(header, dtype='>u4', count=1, offset=mgh_dtype_offset)[0])
+        dtype = MGHArrayIO().dtype_from_id(dtype_id)
+
+        # MGH files store data in fortran order
+        if use_mmap:
+            with tempfile.TemporaryFile(dir=spill_dir) as payload:
+                data = np.memmap(payload, dtype=dtype, mode='w+', shape=shape, order='F')
+        else:
+            data = np.empty(shape, dtype=dtype, order='F')
+        read_exactly(file, data, infile)
+
+        footer = file.read()
+
+    # Let surfa parse the scan parameters and tags, by loading a stub file
+    # with the same header and footer but only a single voxel
+    stub_header = bytearray(header)
+    stub_header[mgh_shape_offset:mgh_shape_offset + 16] = np.ones(4, dtype='>u4').tobytes()
+    stub = tempfile.NamedTemporaryFile(suffix='.mgh', delete=False)
+    try:
+        with stub:
+            stub.write(stub_header)
+            stub.write(bytes(dtype.itemsize))
+            stub.write(footer)
+        metadata = sf.load_volume(stub.name).metadata
+    finally:
+        os.remove(stub.name)
+
+    mgz = sf.Volume(data, metadata=metadata)
+    if np.frombuffer(header, dtype='>u2', count=1, offset=mgh_good_ras_offset)[0]:
+        mgz.geom.update(
+            voxsize=np.frombuffer(header, dtype='>f4', count=3, offset=mgh_voxsize_offset),
+            rotation=np.frombuffer(header, dtype='>f4', count=9, offset=mgh_rotation_offset).reshape((3, 3), order='F'),
+            center=np.frombuffer(header, dtype='>f4', count=3, offset=mgh_center_offset),
+        )
+    return mgz
+
+def get_spill_dir(outfile, tmpdir=None):
+    # Where to put temporary files holding whole volumes; see mmap_load_threshold
+    return tmpdir if tmpdir is not None else os.path.dirname(os.path.abspath(outfile))
+
+def save_mgz(mgz, outfile, compresslevel=None, spill_dir=None):
+    # surfa doesn't let us choose the compression level, so if one is given
+    # have it write an uncompressed mgh file in spill_dir and compress that
+    # ourselves
+    if not str(outfile).lower().endswith('.mgz') or compresslevel is None:
+        mgz.save(outfile)
+        return
+    fd, tmpfile = tempfile.mkstemp(suffix='.mgh', dir=spill_dir)
+    os.close(fd)
+    try:
+        mgz.save(tmpfile)
+        with open(tmpfile, 'rb') as src, gzip.open(outfile, 'wb', compresslevel=compresslevel) as dst:
+            shutil.copyfileobj(src, dst, gzip_buffer_size)
+    finally:
+        os.remove(tmpfile)
+
+def iter_min_max(np_array, block_size=scan_block_size):
+    # Yield the running min and max after each block. Reducing a block at a
+    # time means the max() reduction reads the block from cache rather than
+    # streaming the whole volume a second time, and lets callers stop early
+    flat_array = np_array.ravel(order='K')
+    min_val = flat_array[:block_size].min()
+    max_val = flat_array[:block_size].max()
+    yield min_val, max_val
+    for start in range(block_size, flat_array.size, block_size):
+        block = flat_array[start:start + block_size]
+        min_val = np.minimum(min_val, block.min())
+        max_val = np.maximum(max_val, block.max())
+        yield min_val, max_val
+
+def smallest_dtype_for_range(min_val, max_val, dtype_bounds=mgz_dtype_bounds):
+    # Find the smallest dtype that can accommodate the range. The dtypes are
+    # ordered by size, so argmax picks the first one that fits
+    dtype_names, dtype_mins, dtype_maxs = dtype_bounds
+    fits = (dtype_mins <= min_val) & (max_val <= dtype_maxs)
+    idx = np.argmax(fits)
+    return dtype_names[idx] if fits[idx] else None
+
+def find_best_dtype(np_array, dtype_bounds=mgz_dtype_bounds):
+    # If every value the array's dtype can hold fits the smallest candidate
+    # (e.g. the file is already '>u1'), there is no need to scan the data
+    if np.issubdtype(np_array.dtype, np.integer):
+        info = np.iinfo(np_array.dtype)
+        dtype_str = smallest_dtype_for_range(info.min, info.max, dtype_bounds)
+        if dtype_str == dtype_bounds[0][0]:
             return dtype_str
-    return None
+
+    # A strided sample is cheap to check: if its range already fits none of
+    # the candidates, neither does the whole volume. The reverse isn't true,
+    # so otherwise we still need the full scan below
+    flat_array = np_array.ravel(order='K')
+    sample = flat_array[::max(1, flat_array.size // dtype_sample_size)]
+    if smallest_dtype_for_range(sample.min(), sample.max(), dtype_bounds) is None:
+        return None
+
+    for min_val, max_val in iter_min_max(np_array):
+        best_dtype = smallest_dtype_for_range(min_val, max_val, dtype_bounds)
+        # The range only widens as more blocks are read, so once no candidate
+        # fits there is no point in scanning the rest of the volume
+        if best_dtype is None:
+            break
+    return best_dtype
+
+def convert_dtype(mgz, new_dtype):
+    new_dtype = np.dtype(new_dtype)
+    if mgz.dtype != new_dtype and mgz.dtype.newbyteorder('S') == new_dtype and mgz.data.flags.writeable:
+        # Only the byte order differs (e.g. native-endian data being saved as
+        # big-endian mgz), so swap the bytes in place rather than casting into
+        # a new array. This modifies mgz, which the caller no longer needs
+        data = mgz.data
+        data.byteswap(inplace=True)
+        return mgz.new(data.view(new_dtype))
+    # Files that already have the best dtype don't need their data copied
+    if mgz.dtype == new_dtype:
+        return mgz
+    # Otherwise cast into a reused output buffer instead of a fresh array. The
+    # returned volume is only valid until the next call
+    order = 'F' if mgz.data.flags.f_contiguous else 'C'
+    key = (mgz.data.shape, new_dtype, order)
+    buf = out_buf_cache.get(key)
+    if buf is None:
+        out_buf_cache.clear()
+        buf = np.empty(mgz.data.shape, dtype=new_dtype, order=order)
+        out_buf_cache[key] = buf
+    np.copyto(buf, mgz.data, casting='unsafe')
+    return mgz.new(buf)
 
 def guess_intent_code_from_filename(filename):
     # Strip the directory info
     file = os.path.basename(filename)
-    if file in mgz_label_files:
+    if file in mgz_label_file_set:
         return FramedArrayIntents.label
     else:
         return None
 
-def optimize_mgz(infile, outfile, intent=FramedArrayIntents.unknown, force_convert_to_ints=False):
-    logger.debug(f'infile:  {infile}')
-    logger.debug(f'outfile: {outfile}')
-    logger.debug(f'intent:  {intent}')
-    logger.debug(f'force_convert_to_ints: {force_convert_to_ints}')
-
+def load_input_volume(infile, outfile, tmpdir=None):
+    # Returns None if the file can't be loaded
     logger.info(f'loading mgz file: {infile}')
     try:
-        mgz = sf.load_volume(infile)
+        if str(infile).lower().endswith('.mgz'):
+            use_mmap = os.path.getsize(infile) > mmap_load_threshold
+            spill_dir = get_spill_dir(outfile, tmpdir)
+            if use_mmap:
+                logger.debug(f'{infile} is larger than {mmap_load_threshold} bytes; memory-mapping it in {spill_dir}')
+            mgz = load_mgz(infile, use_mmap=use_mmap, spill_dir=spill_dir)
+        else:
+            mgz = sf.load_volume(infile)
     except Exception as e:
         logger.warning(f'Caught an exception when trying to load {infile}')
         logger.warning(f'{e}', exc_info=True)
         logger.warning(f'Skipping this file')
-        return
+        return None
     logger.debug(f'metadata for {infile}: {mgz.metadata}')
+    return mgz
+
+def optimize_volume(mgz, infile, outfile, intent=None, force_convert_to_ints=False,
+                    compresslevel=None, tmpdir=None):
+    logger.debug(f'infile:  {infile}')
+    logger.debug(f'outfile: {outfile}')
+    logger.debug(f'intent:  {intent}')
+    logger.debug(f'force_convert_to_ints: {force_convert_to_ints}')
+    logger.debug(f'compresslevel: {compresslevel}')
 
     if not np.issubdtype(mgz.dtype, np.integer) and not force_convert_to_ints:
         logger.info(f'mgz file is not integer based and --force is not enabled; skipping')
@@ -217,18 +460,13 @@ def optimize_mgz(infile, outfile, intent=FramedArrayIntents.unknown, force_conve
         logger.debug(f'Best dtype for this file is {new_dtype}')
         if new_dtype is None:
             logger.warning(f'Cant find a suitable dtype for {infile}; just copying the file as-is')
-            mgz_new = mgz.copy()
+            # mgz is not used after this, so there's no need to copy the data
+            mgz_new = mgz
         else:
-            mgz_new = mgz.astype(new_dtype)
-        # PW: Shouldn't this be done by mgz.copy() and mgz.astype()?
-        mgz_new.metadata = mgz.metadata.copy()
-        # if intent code is already set, and force is not set; skip
-        if intent is None:
-            pass
-        elif intent == FramedArrayIntents.unknown:
-            # try to guess the intent code from the filename
-            intent = guess_intent_code_from_filename(infile)
-            logger.info(f'intent was None, so I guessed from the filename that it should be {intent}')
+            mgz_new = convert_dtype(mgz, new_dtype)
+        # No need to copy the metadata here: Volume.new() (used by astype() and
+        # convert_dtype()) already deep copies it, and otherwise mgz_new is mgz
+        # intent has already been resolved by check_args(); None means leave it alone
         if intent is not None:
             logger.debug(f"setting metadata['intent'] to {intent}")
             mgz_new.metadata['intent'] = intent
@@ -236,30 +474,69 @@ def optimize_mgz(infile, outfile, intent=FramedArrayIntents.unknown, force_conve
             logger.debug(f'--ignore-intent was set, not setting or changing intent code')
         logger.info(f'Writing to file: {outfile}')
         logger.debug(f'metadata for {outfile}: {mgz_new.metadata}')
-        mgz_new.save(outfile)
+        save_mgz(mgz_new, outfile, compresslevel=compresslevel, spill_dir=get_spill_dir(outfile, tmpdir))
 
-def main():
-    args = parse_args()
+def optimize_mgz(infile, outfile, intent=None, force_convert_to_ints=False,
+                 compresslevel=None, tmpdir=None):
+    mgz = load_input_volume(infile, outfile, tmpdir=tmpdir)
+    if mgz is not None:
+        optimize_volume(mgz, infile, outfile, intent=intent, force_convert_to_ints=force_convert_to_ints,
+                        compresslevel=compresslevel, tmpdir=tmpdir)
+
+def setup_logging(log_level):
     logging.basicConfig(
-        level=args.log_level,
+        level=log_level,
         format='%(asctime)s - %(name)s - %(funcName)s - %(levelname)s - %(message)s',
         stream=sys.stdout,
         force=True
     )
+
+def main():
+    args = parse_args()
+    setup_logging(args.log_level)
     logger.debug(f'args: {args}')
     logger.debug(f'mgz_dtype_info: {mgz_dtype_info}')
     logger.debug(f'mgz_label_files: {mgz_label_files}')
 
-    infilelist, outfilelist, intent = check_args(args)
+    infilelist, outfilelist, intentlist = check_args(args)
 
     logger.debug(f'infilelist: {infilelist}')
     logger.debug(f'outfilelist: {outfilelist}')
-    logger.debug(f'intent: {intent}')
-    assert(len(infilelist) == len(outfilelist))
+    logger.debug(f'intentlist: {intentlist}')
+    assert(len(infilelist) == len(outfilelist) == len(intentlist))
+
+    # No point starting more workers than there are files; a single file also
+    # avoids the process pool's startup cost entirely
+    jobs = min(args.jobs, max(1, len(infilelist)))
+    logger.debug(f'jobs: {jobs}')
 
-    for i in range(len(infilelist)):
-        logger.debug('------------------------------')
-        optimize_mgz(infilelist[i], outfilelist[i], intent=intent, force_convert_to_ints=args.force)
+    if jobs == 1:
+        # Load the next file in a background thread while the current one is
+        # optimized and saved; decompression and file I/O release the GIL
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            if infilelist:
+                next_load = executor.submit(load_input_volume, infilelist[0], outfilelist[0], args.tmpdir)
+            for i in range(len(infilelist)):
+                logger.debug('------------------------------')
+                mgz = next_load.result()
+                if i + 1 < len(infilelist):
+                    next_load = executor.submit(load_input_volume, infilelist[i + 1], outfilelist[i + 1], args.tmpdir)
+                if mgz is not None:
+                    optimize_volume(mgz, infilelist[i], outfilelist[i], intent=intentlist[i],
+                                    force_convert_to_ints=args.force, compresslevel=args.compresslevel,
+                                    tmpdir=args.tmpdir)
+    else:
+        # Each file is loaded, optimized and saved independently, so fan them out
+        # over worker processes. Workers need their own logging setup when they
+        # are spawned rather than forked.
+        optimize = functools.partial(optimize_mgz, force_convert_to_ints=args.force,
+                                     compresslevel=args.compresslevel, tmpdir=args.tmpdir)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                    initializer=setup_logging,
+                                                    initargs=(args.log_level,)) as executor:
+            # Consume the results so exceptions from the workers are raised here
+            for _ in executor.map(optimize, infilelist, outfilelist, intentlist):
+                pass
     return 0
 
 if __name__ == "__main__":